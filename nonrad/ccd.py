@@ -8,8 +8,10 @@ This module contains various convenience utilities for working with and
 preparing input for nonrad.
 """
 
-from itertools import groupby
-from typing import List, Optional, Tuple
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Optional, Tuple
 
 import numpy as np
 from scipy.optimize import curve_fit
@@ -19,6 +21,19 @@ from pymatgen import Structure
 from pymatgen.io.vasp.outputs import Vasprun
 
 
+def _parabola(Q: np.ndarray, omega: float, Q0: float,
+              dE: float) -> np.ndarray:
+    """Evaluate the harmonic PES."""
+    return 0.5 * omega**2 * (Q - Q0)**2 + dE
+
+
+def _parabola_jac(Q: np.ndarray, omega: float, Q0: float,
+                  dE: float) -> np.ndarray:    # pylint: disable=W0613
+    """Evaluate the jacobian of the harmonic PES wrt (omega, Q0, dE)."""
+    dQ = Q - Q0
+    return np.column_stack([omega * dQ**2, -omega**2 * dQ, np.ones_like(dQ)])
+
+
 def get_cc_structures(
         ground: Structure,
         excited: Structure,
@@ -52,11 +67,50 @@ def get_cc_structures(
     displacements = np.array(displacements)
     if remove_zero:
         displacements = displacements[displacements != 0.]
-    ground_structs = ground.interpolate(excited, nimages=displacements)
-    excited_structs = ground.interpolate(excited, nimages=(displacements + 1.))
+    if len(ground) != len(excited):
+        raise ValueError('Structures have different lengths!')
+    if ground.species_and_occu != excited.species_and_occu:
+        raise ValueError('Different species!')
+    if ground.lattice != excited.lattice:
+        raise ValueError('Structures with different lattices!')
+
+    # same linear interpolation (with periodic wrapping) as
+    # Structure.interpolate, but the displacement is only computed once
+    lattice, species, props = \
+        (ground.lattice, ground.species_and_occu, ground.site_properties)
+    fcoords = ground.frac_coords
+    dfcoords = excited.frac_coords - fcoords
+    dfcoords -= np.round(dfcoords)
+    ground_structs = [Structure(lattice, species, fcoords + x * dfcoords,
+                                site_properties=props)
+                      for x in displacements]
+    excited_structs = [Structure(lattice, species,
+                                 fcoords + (x + 1.) * dfcoords,
+                                 site_properties=props)
+                       for x in displacements]
     return ground_structs, excited_structs
 
 
+def _get_displacements(ground: Structure, excited: Structure) -> np.ndarray:
+    """Compute the minimum-image displacement of each site.
+
+    Parameters
+    ----------
+    ground : pymatgen.core.structure.Structure
+        pymatgen structure corresponding to the ground (final) state
+    excited : pymatgen.core.structure.Structure
+        pymatgen structure corresponding to the excited (initial) state
+
+    Returns
+    -------
+    np.array(float)
+        (N, 3) array of cartesian displacements (Angstrom) from ground to
+        excited
+    """
+    dfrac = excited.frac_coords - ground.frac_coords
+    return ground.lattice.get_cartesian_coords(dfrac - np.round(dfrac))
+
+
 def get_dQ(ground: Structure, excited: Structure) -> float:
     """Calculate dQ from the initial and final structures.
 
@@ -72,10 +126,96 @@ def get_dQ(ground: Structure, excited: Structure) -> float:
     float
         the dQ value (amu^{1/2} Angstrom)
     """
-    return np.sqrt(np.sum(list(map(
-        lambda x: x[0].distance(x[1])**2 * x[0].specie.atomic_mass,
-        zip(ground, excited)
-    ))))
+    disp = _get_displacements(ground, excited)
+    masses = np.array([site.specie.atomic_mass for site in ground])
+    return np.sqrt(np.einsum('ij,ij,i->', disp, disp, masses))
+
+
+def _most_common(x: np.ndarray, decimals: int = 6) -> float:
+    """Find the most common value after rounding.
+
+    Parameters
+    ----------
+    x : np.array(float)
+        values to search
+    decimals : int
+        number of decimals to round to before counting
+
+    Returns
+    -------
+    float
+        the most common rounded value (the smallest one in case of ties)
+    """
+    # values that don't fit in an int64 key after scaling can only come from
+    # (nearly) static components and are discarded
+    scaled = np.round(x[np.abs(x) < 2**62 / 10**decimals] * 10**decimals)
+    smin, smax = (scaled.min(), scaled.max())
+    # bincount is O(N) but allocates the full key range, so fall back to
+    # sorting when a few outliers spread the keys out; the range is checked
+    # in float since it can overflow int64
+    if smax - smin <= max(4 * scaled.size, 1 << 16):
+        shift = int(smin)
+        keys = scaled.astype(np.int64) - shift
+        return (np.bincount(keys).argmax() + shift) / 10**decimals
+    vals, counts = np.unique(scaled, return_counts=True)
+    return vals[counts.argmax()] / 10**decimals
+
+
+class _QPrep(NamedTuple):
+    """Structure-independent data needed to evaluate Q."""
+
+    gc: np.ndarray
+    denom: np.ndarray
+    mask: np.ndarray
+    dQ: float
+
+
+def _Q_prep(ground: Structure, excited: Structure, tol: float) -> _QPrep:
+    """Precompute the data shared by every Q evaluation for the endpoints.
+
+    Parameters
+    ----------
+    ground : pymatgen.core.structure.Structure
+        pymatgen structure corresponding to the ground (final) state
+    excited : pymatgen.core.structure.Structure
+        pymatgen structure corresponding to the excited (initial) state
+    tol : float
+        distance cutoff to throw away sites for determining Q
+
+    Returns
+    -------
+    _QPrep
+        ground coordinates and displacements of the moving sites, the mask
+        selecting them, and the dQ value
+    """
+    mask = np.linalg.norm(_get_displacements(ground, excited), axis=1) >= tol
+    gc = ground.cart_coords[mask]
+    return _QPrep(gc, excited.cart_coords[mask] - gc, mask,
+                  get_dQ(ground, excited))
+
+
+def _Q_eval(prep: _QPrep, struct: Structure) -> float:
+    """Evaluate the Q value of a structure from precomputed endpoint data.
+
+    Parameters
+    ----------
+    prep : _QPrep
+        data returned by _Q_prep
+    struct : pymatgen.core.structure.Structure
+        pymatgen structure corresponding to the structure we want to calculate
+        the Q value for
+
+    Returns
+    -------
+    float
+        the Q value (amu^{1/2} Angstrom) of the structure
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = ((struct.cart_coords[prep.mask] - prep.gc) /
+                  prep.denom).ravel()
+    # components that don't move give inf/nan and carry no information
+    ratios = ratios[np.isfinite(ratios)]
+    return prep.dQ * _most_common(ratios)
 
 
 def get_Q_from_struct(
@@ -109,23 +249,87 @@ def get_Q_from_struct(
     """
     if isinstance(struct, str):
         struct = Structure.from_file(struct)
+    return _Q_eval(_Q_prep(ground, excited, tol), struct)
+
 
-    dQ = get_dQ(ground, excited)
-    possible_x = []
-    for i, site in enumerate(struct):
-        if ground[i].distance(excited[i]) < tol:
-            continue
-        possible_x += ((site.coords - ground[i].coords) /
-                       (excited[i].coords - ground[i].coords)).tolist()
-    spossible_x = np.sort(np.round(possible_x, 6))
-    return dQ * max(groupby(spossible_x), key=lambda x: len(list(x[1])))[0]
+class _VasprunExtract(NamedTuple):
+    """Minimal information kept from a parsed vasprun.xml."""
+
+    final_energy: float
+    structure: Structure
+
+
+def _parse_vasprun(vr_fname: str) -> _VasprunExtract:
+    """Parse a vasprun.xml file, keeping only the final energy and structure.
+
+    Parameters
+    ----------
+    vr_fname : string
+        path to the vasprun.xml file
+
+    Returns
+    -------
+    _VasprunExtract
+        the final energy (eV) and final structure of the calculation
+    """
+    vr = Vasprun(vr_fname, parse_dos=False, parse_eigen=False)
+    return _VasprunExtract(vr.final_energy, vr.structures[-1])
+
+
+# parsed vasprun.xml files keyed by (path, mtime), least recently used first
+_VASPRUN_CACHE: 'OrderedDict[Tuple[str, float], _VasprunExtract]' = \
+    OrderedDict()
+_VASPRUN_CACHE_SIZE = 32
+
+
+def _read_vaspruns(
+        vr_fnames: List[str],
+        nproc: Optional[int] = 1
+) -> List[_VasprunExtract]:
+    """Parse vasprun.xml files, reusing previously parsed ones.
+
+    Files that are not cached yet (or were modified since) are parsed,
+    optionally in parallel, and the most recently used files are kept.
+
+    Parameters
+    ----------
+    vr_fnames : list(strings)
+        a list of paths to the vasprun.xml files
+    nproc : int
+        number of processes used to parse the uncached files in parallel
+        (default is 1, None uses all available cores)
+
+    Returns
+    -------
+    list(_VasprunExtract)
+        the final energy (eV) and final structure of each calculation
+    """
+    keys = [(str(vr_fname), os.path.getmtime(vr_fname))
+            for vr_fname in vr_fnames]
+    misses = [key for key in dict.fromkeys(keys) if key not in _VASPRUN_CACHE]
+    if nproc == 1 or len(misses) < 2:
+        parsed = [_parse_vasprun(vr_fname) for vr_fname, _ in misses]
+    else:
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            parsed = list(executor.map(_parse_vasprun,
+                                       [vr_fname for vr_fname, _ in misses]))
+    _VASPRUN_CACHE.update(zip(misses, parsed))
+
+    extracts = []
+    for key in keys:
+        _VASPRUN_CACHE.move_to_end(key)
+        extracts.append(_VASPRUN_CACHE[key])
+    while len(_VASPRUN_CACHE) > _VASPRUN_CACHE_SIZE:
+        _VASPRUN_CACHE.popitem(last=False)
+    return extracts
 
 
 def get_PES_from_vaspruns(
         ground: Structure,
         excited: Structure,
         vasprun_paths: List[str],
-        tol: float = 0.001
+        tol: float = 0.001,
+        nproc: Optional[int] = 1
 ) -> Tuple[np.ndarray, np.ndarray]:
     """Extract the potential energy surface (PES) from vasprun.xml files.
 
@@ -144,6 +348,9 @@ def get_PES_from_vaspruns(
         and each path should end in 'vasprun.xml' (e.g. /path/to/vasprun.xml)
     tol : float
         tolerance to pass to get_Q_from_struct
+    nproc : int
+        number of processes used to parse the vasprun.xml files in parallel
+        (default is 1, None uses all available cores)
 
     Returns
     -------
@@ -152,12 +359,10 @@ def get_PES_from_vaspruns(
     energy : np.array(float)
         array of energies (eV) corresponding to each vasprun
     """
-    num = len(vasprun_paths)
-    Q, energy = (np.zeros(num), np.zeros(num))
-    for i, vr_fname in enumerate(vasprun_paths):
-        vr = Vasprun(vr_fname, parse_dos=False, parse_eigen=False)
-        Q[i] = get_Q_from_struct(ground, excited, vr.structures[-1], tol=tol)
-        energy[i] = vr.final_energy
+    extracts = _read_vaspruns(vasprun_paths, nproc=nproc)
+    prep = _Q_prep(ground, excited, tol)
+    Q = np.array([_Q_eval(prep, ex.structure) for ex in extracts])
+    energy = np.array([ex.final_energy for ex in extracts])
     return Q, (energy - np.min(energy))
 
 
@@ -188,19 +393,21 @@ def get_omega_from_PES(
     float
         harmonic phonon frequency from the PES in eV
     """
-    def f(Q, omega, Q0, dE):
-        return 0.5 * omega**2 * (Q - Q0)**2 + dE
-
-    # set bounds to restrict Q0 to the given Q0 value
-    bounds = (-np.inf, np.inf) if Q0 is None else \
-        ([-np.inf, Q0 - 1e-10, -np.inf], [np.inf, Q0, np.inf])
-    popt, _ = curve_fit(f, Q, energy, bounds=bounds)    # pylint: disable=W0632
+    if Q0 is None:
+        popt, _ = curve_fit(_parabola, Q, energy,     # pylint: disable=W0632
+                            jac=_parabola_jac)
+    else:
+        # with Q0 fixed the model is linear in (omega**2, dE)
+        x = 0.5 * (np.asarray(Q) - Q0)**2
+        A = np.column_stack([x, np.ones_like(x)])
+        (a, dE), *_ = np.linalg.lstsq(A, energy, rcond=None)
+        popt = np.array([np.sqrt(max(a, 0.)), Q0, dE])
 
     # optional plotting to check fit
     if ax is not None:
         q_L = np.max(Q) - np.min(Q)
         if q is None:
             q = np.linspace(np.min(Q) - 0.1 * q_L, np.max(Q) + 0.1 * q_L, 1000)
-        ax.plot(q, f(q, *popt))
+        ax.plot(q, _parabola(q, *popt))
 
     return HBAR * popt[0] * np.sqrt(EV2J / (ANGS2M**2 * AMU2KG))
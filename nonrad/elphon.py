@@ -8,8 +8,12 @@ This module provides various utilities to evaluate electron-phonon coupling
 strength using different first-principles codes.
 """
 
+import os
 import re
-from typing import Dict, List, Optional, Sequence, Tuple
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 from monty.io import zopen
@@ -18,6 +22,67 @@ from pymatgen.electronic_structure.core import Spin
 from pymatgen.io.vasp.outputs import BSVasprun, Wavecar
 from pymatgen.io.wannier90 import Unk
 
+# matches either a (spin, kpoint) header or an (i, j) overlap line of WSWQ
+_WSWQ_RE = re.compile(rb'\s*(?:spin=(\d+), kpoint=\s*(\d+)|'
+                      rb'i=\s*(\d+), j=\s*(\d+)\s*:\s*(\S+)\s+(\S+))')
+
+try:
+    from numba import njit, prange
+
+    @njit(cache=True, fastmath=True)
+    def _matel_kernel(psi0: np.ndarray, psi1: np.ndarray) -> float:
+        """Compute the normalized overlap in a single pass over memory."""
+        n0, n1, c = (0., 0., 0j)
+        for i in range(psi0.size):
+            x, y = (psi0[i], psi1[i])
+            n0 += x.real * x.real + x.imag * x.imag
+            n1 += y.real * y.real + y.imag * y.imag
+            c += x.conjugate() * y
+        return abs(c) / np.sqrt(n0 * n1)
+except ModuleNotFoundError:
+    def _matel_kernel(psi0: np.ndarray,     # type: ignore
+                      psi1: np.ndarray) -> float:
+        """Compute the normalized overlap with numpy."""
+        return np.abs(np.vdot(psi0, psi1)) / \
+            np.sqrt(np.abs(np.vdot(psi0, psi0) * np.vdot(psi1, psi1)))
+
+    prange = range      # type: ignore
+
+    def njit(*args, **kwargs):      # type: ignore # pylint: disable=W0613
+        """Fake njit when numba can't be found."""
+        def _njit(func):
+            return func
+        return _njit
+
+
+@njit(cache=True, parallel=True)
+def _mean_abs_grad(matels: np.ndarray, Q: np.ndarray,
+                   out: np.ndarray) -> None:
+    """Compute np.mean(np.abs(np.gradient(row, Q))) for each row of matels.
+
+    Parameters
+    ----------
+    matels : np.array(float)
+        (Nbi, N) array of matrix elements as a function of Q, N >= 2
+    Q : np.array(float)
+        array of the N Q values
+    out : np.array(float)
+        array of length Nbi that the result is written into
+    """
+    N = Q.size
+    for i in prange(matels.shape[0]):
+        f = matels[i]
+        # first order differences at the edges, second order in the interior
+        acc = abs((f[1] - f[0]) / (Q[1] - Q[0])) + \
+            abs((f[N-1] - f[N-2]) / (Q[N-1] - Q[N-2]))
+        for j in range(1, N-1):
+            hd, hs = (Q[j] - Q[j-1], Q[j+1] - Q[j])
+            # same coefficients as np.gradient (so degenerate Q give nan)
+            acc += abs(-hs / (hd * (hd + hs)) * f[j-1]
+                       + (hs - hd) / (hd * hs) * f[j]
+                       + hd / (hs * (hd + hs)) * f[j+1])
+        out[i] = acc / N
+
 
 def _compute_matel(psi0: np.ndarray, psi1: np.ndarray) -> float:
     """Compute the inner product of the two wavefunctions.
@@ -34,9 +99,40 @@ def _compute_matel(psi0: np.ndarray, psi1: np.ndarray) -> float:
     float
         inner product np.abs(<psi0 | psi1>)
     """
-    npsi0 = psi0 / np.sqrt(np.abs(np.vdot(psi0, psi0)))
-    npsi1 = psi1 / np.sqrt(np.abs(np.vdot(psi1, psi1)))
-    return np.abs(np.vdot(npsi0, npsi1))
+    dtype = np.result_type(psi0, psi1, np.complex64)
+    return _matel_kernel(np.ascontiguousarray(psi0, dtype=dtype).ravel(),
+                         np.ascontiguousarray(psi1, dtype=dtype).ravel())
+
+
+def _stack_coeffs(
+        wavecar: Union[Wavecar, str],
+        indices: Sequence[int],
+        spin: int = 0,
+        kpoint: int = 1
+) -> np.ndarray:
+    """Stack the plane-wave coefficients of the given bands row-wise.
+
+    Parameters
+    ----------
+    wavecar : pymatgen.io.vasp.outputs.Wavecar or str
+        wavecar to read the coefficients from (may also be a path to a
+        WAVECAR file, in which case only the stacked coefficients are kept)
+    indices : list(int)
+        indices of the bands to extract (1-based indexing)
+    spin : int
+        spin channel to read from (0 - up, 1 - down)
+    kpoint : int
+        kpoint to read from (defaults to the first kpoint)
+
+    Returns
+    -------
+    np.array
+        (len(indices), Ng) array of flattened coefficients
+    """
+    if not isinstance(wavecar, Wavecar):
+        wavecar = Wavecar(wavecar)
+    coeffs = wavecar.coeffs[spin] if wavecar.spin == 2 else wavecar.coeffs
+    return np.stack([coeffs[kpoint-1][i-1].ravel() for i in indices])
 
 
 def get_Wif_from_wavecars(
@@ -86,12 +182,13 @@ def get_Wif_from_wavecars(
         electron-phonon matrix element Wif in units of
         eV amu^{-1/2} Angstrom^{-1} for each bulk_index
     """
+    if len(wavecars) < 1:
+        raise ValueError('at least one displaced wavecar must be specified')
+
     bulk_index = np.array(bulk_index)
     initial_wavecar = Wavecar(init_wavecar_path)
-    if initial_wavecar.spin == 2:
-        psi_i = initial_wavecar.coeffs[spin][kpoint-1][def_index-1]
-    else:
-        psi_i = initial_wavecar.coeffs[kpoint-1][def_index-1]
+    psi_i = _stack_coeffs(initial_wavecar, [def_index], spin, kpoint)[0]
+    psi_i_conj, ni = (psi_i.conj(), np.linalg.norm(psi_i))
 
     Nw, Nbi = (len(wavecars), len(bulk_index))
     Q, matels, deig = (np.zeros(Nw+1), np.zeros((Nbi, Nw+1)), np.zeros(Nbi))
@@ -99,26 +196,34 @@ def get_Wif_from_wavecars(
     # first compute the Q = 0 values and eigenvalue differences
     for i, bi in enumerate(bulk_index):
         if initial_wavecar.spin == 2:
-            psi_f = initial_wavecar.coeffs[spin][kpoint-1][bi-1]
             deig[i] = initial_wavecar.band_energy[spin][kpoint-1][bi-1][0] - \
                 initial_wavecar.band_energy[spin][kpoint-1][def_index-1][0]
         else:
-            psi_f = initial_wavecar.coeffs[kpoint-1][bi-1]
             deig[i] = initial_wavecar.band_energy[kpoint-1][bi-1][0] - \
                 initial_wavecar.band_energy[kpoint-1][def_index-1][0]
-        matels[i, Nw] = _compute_matel(psi_i, psi_f)
     deig = np.abs(deig)
-
-    # now compute for each Q
-    for i, (q, fname) in enumerate(wavecars):
-        Q[i] = q
-        final_wavecar = Wavecar(fname)
-        for j, bi in enumerate(bulk_index):
-            if final_wavecar.spin == 2:
-                psi_f = final_wavecar.coeffs[spin][kpoint-1][bi-1]
-            else:
-                psi_f = final_wavecar.coeffs[kpoint-1][bi-1]
-            matels[j, i] = _compute_matel(psi_i, psi_f)
+    psi_f = _stack_coeffs(initial_wavecar, bulk_index, spin, kpoint)
+    matels[:, Nw] = np.abs(psi_f @ psi_i_conj) / \
+        (np.linalg.norm(psi_f, axis=1) * ni)
+
+    del initial_wavecar
+
+    # now compute for each Q, reading the next WAVECAR in the background
+    # while the overlaps are evaluated; only one full WAVECAR is loaded at a
+    # time, the rest are reduced to the stacked bulk coefficients
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = None
+        for i, (q, fname) in enumerate(wavecars):
+            if future is None:
+                future = executor.submit(_stack_coeffs, fname, bulk_index,
+                                         spin, kpoint)
+            psi_f = future.result()
+            future = None if i + 1 == Nw else \
+                executor.submit(_stack_coeffs, wavecars[i+1][1], bulk_index,
+                                spin, kpoint)
+            Q[i] = q
+            matels[:, i] = np.abs(psi_f @ psi_i_conj) / \
+                (np.linalg.norm(psi_f, axis=1) * ni)
 
     if fig is not None:
         ax = fig.subplots(1, Nbi)
@@ -127,8 +232,9 @@ def get_Wif_from_wavecars(
             a.scatter(Q, matels[i, :])
             a.set_title(f'{bulk_index[i]}')
 
-    return [(bi, deig[i] * np.mean(np.abs(np.gradient(matels[i, :], Q))))
-            for i, bi in enumerate(bulk_index)]
+    grads = np.zeros(Nbi)
+    _mean_abs_grad(matels, Q, grads)
+    return [(bi, deig[i] * grads[i]) for i, bi in enumerate(bulk_index)]
 
 
 def get_Wif_from_UNK(
@@ -170,6 +276,9 @@ def get_Wif_from_UNK(
         electron-phonon matrix element Wif in units of
         eV amu^{-1/2} Angstrom^{-1} for each bulk_index
     """
+    if len(unks) < 1:
+        raise ValueError('at least one displaced unk must be specified')
+
     bulk_index = np.array(bulk_index)
     initial_unk = Unk.from_file(init_unk_path)
     psi_i = initial_unk.data[def_index-1].flatten()
@@ -201,45 +310,206 @@ def get_Wif_from_UNK(
             a.scatter(Q, matels[i, :])
             a.set_title(f'{bulk_index[i]}')
 
-    return [(bi, deig[i] * np.mean(np.abs(np.gradient(matels[i, :], Q))))
-            for i, bi in enumerate(bulk_index)]
+    grads = np.zeros(Nbi)
+    _mean_abs_grad(matels, Q, grads)
+    return [(bi, deig[i] * grads[i]) for i, bi in enumerate(bulk_index)]
+
+
+def _get_WSWQ_cache(fname: str) -> Tuple[str, bool]:
+    """Locate the cache of parsed overlaps for the given WSWQ file.
+
+    The cache records the size and modification time of the WSWQ file it
+    was written from, and is only considered valid if both still match
+    (a newer cache file alone is not enough, e.g. for copies made with
+    ``cp -p`` that keep an older modification time).
+
+    Parameters
+    ----------
+    fname : string
+        path to the WSWQ file
+
+    Returns
+    -------
+    cache_fname : string
+        path to the cache file
+    fresh : bool
+        whether the cache file exists and matches the WSWQ file
+    """
+    cache_fname = str(fname) + '.npz'
+    if not os.path.exists(cache_fname):
+        return cache_fname, False
+    stat = os.stat(fname)
+    with np.load(cache_fname, allow_pickle=False) as data:
+        fresh = '_source' in data.files and np.array_equal(
+            data['_source'], [stat.st_size, stat.st_mtime])
+    return cache_fname, fresh
 
 
-def _read_WSWQ(fname: str) -> Dict:
+def _WSWQ_block_to_array(data: array) -> np.ndarray:
+    """Convert a block of WSWQ overlaps into a complex array.
+
+    Parameters
+    ----------
+    data : array.array
+        flat (i, j, real, imag) values of each overlap in the block
+
+    Returns
+    -------
+    np.array(complex)
+        array of overlaps indexed by [initial-1, final-1]
+    """
+    vals = np.frombuffer(data, dtype=np.float64).reshape(-1, 4)
+    ij = vals[:, :2].astype(int) - 1
+    shape = tuple(ij.max(axis=0) + 1) if len(ij) > 0 else (0, 0)
+    block = np.zeros(shape, dtype=np.complex128)
+    block[ij[:, 0], ij[:, 1]] = vals[:, 2] + 1j * vals[:, 3]
+    return block
+
+
+def _read_WSWQ(fname: str, cache: bool = True) -> Dict:
     """Read the WSWQ file from VASP.
 
     Parameters
     ----------
     fname : string
         path to the WSWQ file to read
+    cache : bool
+        store the parsed overlaps in fname + '.npz' and reuse them on later
+        reads as long as the size and modification time of the WSWQ file are
+        unchanged (default is True)
 
     Returns
     -------
-    dict(dict)
-        a dict of dicts that takes keys (spin, kpoint) and (initial, final) as
-        indices and maps it to a complex number
+    dict(np.array)
+        a dict that takes keys (spin, kpoint) and maps it to a complex array
+        of overlaps indexed by [initial-1, final-1]
     """
-    # whoa, this is horrific
-    wswq: Dict[Optional[Tuple[int, int]], Dict[Tuple[int, int], complex]] = {}
-    current = None
-    with zopen(fname, 'r') as f:
+    cache_fname, fresh = _get_WSWQ_cache(fname)
+    if cache and fresh:
+        with np.load(cache_fname, allow_pickle=False) as data:
+            return {tuple(map(int, k.split('_'))): data[k]
+                    for k in data.files if k != '_source'}
+
+    # each block is stored as flat (i, j, real, imag) doubles and turned into
+    # a complex array once the block is complete
+    wswq: Dict[Tuple[int, int], np.ndarray] = {}
+    key: Optional[Tuple[int, int]] = None
+    current = array('d')
+    with zopen(fname, 'rb') as f:
         for line in f:
-            spin_kpoint = \
-                re.search(r'\s*spin=(\d+), kpoint=\s*(\d+)', str(line))
-            data = \
-                re.search(r'i=\s*(\d+), '
-                          r'j=\s*(\d+)\s*:\s*([0-9\-.]+)\s+([0-9\-.]+)',
-                          str(line))
-            if spin_kpoint:
-                current = \
-                    (int(spin_kpoint.group(1)), int(spin_kpoint.group(2)))
-                wswq[current] = {}
-            elif data:
-                wswq[current][(int(data.group(1)), int(data.group(2)))] = \
-                    complex(float(data.group(3)), float(data.group(4)))
+            match = _WSWQ_RE.match(line)
+            if match is None:
+                continue
+            if match.group(1) is not None:
+                if key is not None:
+                    wswq[key] = _WSWQ_block_to_array(current)
+                key = (int(match.group(1)), int(match.group(2)))
+                current = array('d')
+            else:
+                current.extend(map(float, match.group(3, 4, 5, 6)))
+    if key is not None:
+        wswq[key] = _WSWQ_block_to_array(current)
+
+    if cache:
+        stat = os.stat(fname)
+        arrays = {f'{sp}_{kp}': arr for (sp, kp), arr in wswq.items()}
+        arrays['_source'] = np.array([stat.st_size, stat.st_mtime])
+        try:
+            np.savez(cache_fname, **arrays)     # type: ignore
+        except OSError:
+            pass
     return wswq
 
 
+def _read_WSWQ_targeted(
+        fname: str,
+        spin: int,
+        kpoint: int,
+        pairs: Sequence[Tuple[int, int]]
+) -> Dict[Tuple[int, int], complex]:
+    """Read only the requested overlaps from the WSWQ file from VASP.
+
+    The file is skipped until the requested (spin, kpoint) block, and reading
+    stops as soon as all of the requested overlaps are found. This function
+    never writes a cache, but if a valid one was written by _read_WSWQ it is
+    used instead. Either way, overlaps that are not in the file (or a missing
+    block) are simply left out of the result.
+
+    Parameters
+    ----------
+    fname : string
+        path to the WSWQ file to read
+    spin : int
+        spin channel to read (1-based indexing, as in the WSWQ file)
+    kpoint : int
+        kpoint to read (1-based indexing)
+    pairs : list((int, int))
+        (initial, final) indices of the overlaps to read (1-based indexing)
+
+    Returns
+    -------
+    dict(complex)
+        a dict that takes keys (initial, final) and maps it to a complex number
+    """
+    wanted = set(pairs)
+    cache_fname, fresh = _get_WSWQ_cache(fname)
+    if fresh:
+        with np.load(cache_fname, allow_pickle=False) as data:
+            name = f'{spin}_{kpoint}'
+            if name not in data.files:
+                return {}
+            block = data[name]
+        return {(i, j): complex(block[i-1, j-1]) for i, j in wanted
+                if 1 <= i <= block.shape[0] and 1 <= j <= block.shape[1]}
+
+    found: Dict[Tuple[int, int], complex] = {}
+    in_block = False
+    with zopen(fname, 'rb') as f:
+        for line in f:
+            if b'spin=' in line:
+                if in_block:
+                    break
+                match = _WSWQ_RE.match(line)
+                in_block = match is not None and \
+                    (int(match.group(1)), int(match.group(2))) == \
+                    (spin, kpoint)
+                continue
+            if not in_block:
+                continue
+            # lines look like: i=     1, j=     1 :    -0.426502    -0.904415
+            head, sep, vals = line.partition(b':')
+            if not sep:
+                continue
+            i, j = (int(x.split(b'=')[1]) for x in head.split(b','))
+            if (i, j) in wanted:
+                real, imag = vals.split()
+                found[(i, j)] = complex(float(real), float(imag))
+                if len(found) == len(wanted):
+                    break
+    return found
+
+
+@lru_cache(maxsize=32)
+def _read_eigenvalues(vr_fname: str,
+                      mtime: float) -> Dict:     # pylint: disable=W0613
+    """Read and cache the eigenvalues from a vasprun.xml file.
+
+    Parameters
+    ----------
+    vr_fname : string
+        path to the vasprun.xml file
+    mtime : float
+        modification time of the file, used as part of the cache key so that
+        changed files are read again
+
+    Returns
+    -------
+    dict(np.array)
+        eigenvalues as stored in BSVasprun.eigenvalues
+    """
+    return BSVasprun(vr_fname).eigenvalues
+
+
 def get_Wif_from_WSWQ(
         wswqs: List,
         initial_vasprun: str,
@@ -282,31 +552,40 @@ def get_Wif_from_WSWQ(
     bulk_index = np.array(bulk_index)
 
     Nw, Nbi = (len(wswqs), len(bulk_index))
-    Q, matels, deig = (np.zeros(Nw+1), np.zeros((Nbi, Nw+1)), np.zeros(Nbi))
+    Q, deig = (np.zeros(Nw+1), np.zeros(Nbi))
+    # the matrix elements are only stored when they need to be plotted
+    matels = np.zeros((Nbi, Nw+1)) if fig is not None else None
 
     # first compute the eigenvalue differences
-    bvr = BSVasprun(initial_vasprun)
+    eigenvalues = _read_eigenvalues(initial_vasprun,
+                                    os.path.getmtime(initial_vasprun))
     for i, bi in enumerate(bulk_index):
         sp = Spin.up if spin == 0 else Spin.down
-        deig[i] = bvr.eigenvalues[sp][kpoint-1][bi-1][0]
+        deig[i] = eigenvalues[sp][kpoint-1][bi-1][0]
     deig = np.abs(deig)
 
-    # now compute for each Q
+    # now compute for each Q, accumulating the sums for the linear fit of
+    # each bulk_index (the Q = 0 point has a zero matrix element)
+    Sx, Sxx, Sy, Sxy = (0., 0., np.zeros(Nbi), np.zeros(Nbi))
+    pairs = [(bi, def_index) for bi in bulk_index]
     for i, (q, fname) in enumerate(wswqs):
         Q[i] = q
-        wswq = _read_WSWQ(fname)
-        for j, bi in enumerate(bulk_index):
-            matels[j, i] = np.sign(q) * \
-                np.abs(wswq[(spin+1, kpoint)][(bi, def_index)])
-
-    if fig is not None:
+        wswq = _read_WSWQ_targeted(fname, spin+1, kpoint, pairs)
+        y = np.sign(q) * np.abs([wswq[p] for p in pairs])
+        Sx, Sxx, Sy, Sxy = (Sx + q, Sxx + q**2, Sy + y, Sxy + q * y)
+        if matels is not None:
+            matels[:, i] = y
+    n = Nw + 1
+    slope = (n * Sxy - Sx * Sy) / (n * Sxx - Sx**2)
+    intercept = (Sy - slope * Sx) / n
+
+    if matels is not None:
         ax = fig.subplots(1, Nbi)
         ax = np.array(ax)
         for a, i in zip(ax, range(Nbi)):
             tq = np.linspace(np.min(Q), np.max(Q), 100)
             a.scatter(Q, matels[i, :])
-            a.plot(tq, np.polyval(np.polyfit(Q, matels[i, :], 1), tq))
+            a.plot(tq, slope[i] * tq + intercept[i])
             a.set_title(f'{bulk_index[i]}')
 
-    return [(bi, deig[i] * np.polyfit(Q, matels[i, :], 1)[0])
-            for i, bi in enumerate(bulk_index)]
+    return [(bi, deig[i] * slope[i]) for i, bi in enumerate(bulk_index)]
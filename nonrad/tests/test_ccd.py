@@ -3,13 +3,14 @@
 import glob
 import unittest
 import warnings
+from unittest.mock import patch
 
 import numpy as np
 
 import pymatgen as pmg
 from nonrad.nonrad import AMU2KG, ANGS2M, EV2J, HBAR
 from nonrad.tests import TEST_FILES, FakeAx
-from nonrad.ccd import (get_cc_structures,
+from nonrad.ccd import (_most_common, get_cc_structures,
                         get_dQ, get_omega_from_PES, get_PES_from_vaspruns,
                         get_Q_from_struct)
 
@@ -37,6 +38,26 @@ class CCDTest(unittest.TestCase):
         self.assertEqual(self.exd_test, es[0])
         gs, es = get_cc_structures(self.gnd_test, self.exd_test, [0.5])
         self.assertTrue(np.allclose(gs[0][0].coords, [0.25, 0.25, 0.25]))
+        disp = np.linspace(-0.5, 0.5, 5)
+        gs, es = get_cc_structures(self.gnd_real, self.exd_real, disp,
+                                   remove_zero=False)
+        for s, t in zip(gs, self.gnd_real.interpolate(self.exd_real,
+                                                      nimages=disp)):
+            self.assertEqual(s, t)
+        for s, t in zip(es, self.gnd_real.interpolate(self.exd_real,
+                                                      nimages=disp + 1.)):
+            self.assertEqual(s, t)
+        gnd_dis = pmg.Structure(pmg.Lattice.cubic(1.), [{'H': 0.5, 'He': 0.5}],
+                                [[0., 0., 0.]])
+        exd_dis = pmg.Structure(pmg.Lattice.cubic(1.), [{'H': 0.5, 'He': 0.5}],
+                                [[0.5, 0.5, 0.5]])
+        gs, es = get_cc_structures(gnd_dis, exd_dis, [0.5])
+        self.assertEqual(gs, gnd_dis.interpolate(exd_dis, nimages=[0.5]))
+        self.assertEqual(es, gnd_dis.interpolate(exd_dis, nimages=[1.5]))
+        exd_big = pmg.Structure(pmg.Lattice.cubic(1.2), ['H'],
+                                [[0.5, 0.5, 0.5]])
+        with self.assertRaises(ValueError):
+            get_cc_structures(self.gnd_test, exd_big, [0.5])
 
     def test_get_dQ(self):
         self.assertEqual(get_dQ(self.gnd_test, self.gnd_test), 0.)
@@ -48,6 +69,17 @@ class CCDTest(unittest.TestCase):
         self.assertAlmostEqual(get_dQ(self.gnd_real, self.exd_real), 1.68587,
                                places=4)
 
+    def test__most_common(self):
+        self.assertAlmostEqual(_most_common(np.array([0.5])), 0.5)
+        self.assertAlmostEqual(
+            _most_common(np.array([0.1, 0.2000001, 0.2, 0.3, 0.3])), 0.2)
+        self.assertAlmostEqual(
+            _most_common(np.array([-1e5, 0.25, 0.25, 1e5])), 0.25)
+        self.assertAlmostEqual(
+            _most_common(np.array([0.25, 0.25, 0.5, 2e13])), 0.25)
+        self.assertAlmostEqual(
+            _most_common(np.array([0.25, 0.25, 0.5, 6e12, -6e12])), 0.25)
+
     def test_get_Q_from_struct(self):
         q = get_Q_from_struct(self.gnd_test, self.exd_test, self.sct_test)
         self.assertAlmostEqual(q, 0.5 * 0.86945, places=4)
@@ -74,6 +106,26 @@ class CCDTest(unittest.TestCase):
         self.assertEqual(len(en), 2)
         self.assertEqual(np.min(en), 0.)
         self.assertEqual(en[0], 0.)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            pq, pen = get_PES_from_vaspruns(self.gnd_real, self.exd_real,
+                                            self.vrs, nproc=2)
+        self.assertTrue(np.allclose(pq, q))
+        self.assertTrue(np.allclose(pen, en))
+
+    def test_get_PES_from_vaspruns_cache(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            q, en = get_PES_from_vaspruns(self.gnd_real, self.exd_real,
+                                          self.vrs)
+        # the files are cached now, so neither path should parse them again
+        with patch('nonrad.ccd._parse_vasprun') as parse:
+            for nproc in [1, 2]:
+                cq, cen = get_PES_from_vaspruns(self.gnd_real, self.exd_real,
+                                                self.vrs, nproc=nproc)
+                self.assertTrue(np.allclose(cq, q))
+                self.assertTrue(np.allclose(cen, en))
+            parse.assert_not_called()
 
     def test_get_omega_from_PES(self):
         q = np.linspace(-0.5, 0.5, 20)
@@ -1,16 +1,22 @@
 # pylint: disable=C0114,C0115,C0116
 
 import glob
+import os
+import shutil
+import tempfile
 import unittest
 import warnings
 from itertools import product
+from pathlib import Path
 
 import numpy as np
 
 import pymatgen as pmg
 from nonrad.ccd import get_Q_from_struct
-from nonrad.elphon import (_compute_matel, _read_WSWQ, get_Wif_from_wavecars,
-                           get_Wif_from_WSWQ, get_Wif_from_UNK)
+from nonrad.elphon import (_compute_matel, _get_WSWQ_cache, _mean_abs_grad,
+                           _read_WSWQ, _read_WSWQ_targeted,
+                           get_Wif_from_wavecars, get_Wif_from_WSWQ,
+                           get_Wif_from_UNK)
 from nonrad.tests import TEST_FILES, FakeFig
 
 
@@ -39,6 +45,16 @@ class ElphonTest(unittest.TestCase):
             else:
                 self.assertAlmostEqual(_compute_matel(ev[:, i], ev[:, j]), 0.)
 
+    def test__mean_abs_grad(self):
+        for N in [2, 3, 10]:
+            Q = np.random.rand(N)
+            matels = np.random.rand(4, N)
+            grads = np.zeros(4)
+            _mean_abs_grad(matels, Q, grads)
+            for i in range(4):
+                self.assertAlmostEqual(
+                    grads[i], np.mean(np.abs(np.gradient(matels[i], Q))))
+
     @unittest.skip('WAVECARs too large to share')
     def test_get_Wif_from_wavecars(self):
         with warnings.catch_warnings():
@@ -73,14 +89,64 @@ class ElphonTest(unittest.TestCase):
         )
         self.assertEqual(Wif[0][0], 1)
         self.assertAlmostEqual(Wif[0][1], 1.)
+        with self.assertRaises(ValueError):
+            get_Wif_from_UNK(unks=[], init_unk_path=str(TEST_FILES / 'UNK.0'),
+                             def_index=2, bulk_index=[1],
+                             eigs=np.array([0., 1.]))
 
     def test__read_WSWQ(self):
-        wswq = _read_WSWQ(str(TEST_FILES / 'lower' / '10' / 'WSWQ.gz'))
+        wswq = _read_WSWQ(str(TEST_FILES / 'lower' / '10' / 'WSWQ.gz'),
+                          cache=False)
         self.assertGreater(len(wswq), 0)
         self.assertGreater(len(wswq[(1, 1)]), 0)
-        self.assertGreater(np.abs(wswq[(1, 1)][(1, 1)]), 0)
+        self.assertGreater(np.abs(wswq[(1, 1)][0, 0]), 0)
         self.assertEqual(type(wswq), dict)
-        self.assertEqual(type(wswq[(1, 1)]), dict)
+        self.assertEqual(type(wswq[(1, 1)]), np.ndarray)
+        self.assertEqual(wswq[(1, 1)].shape, (288, 288))
+        self.assertAlmostEqual(wswq[(1, 1)][0, 0], -0.426502-0.904415j)
+
+    def test__read_WSWQ_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = str(Path(tmpdir) / 'WSWQ.gz')
+            shutil.copy(TEST_FILES / 'lower' / '10' / 'WSWQ.gz', fname)
+            wswq = _read_WSWQ(fname)
+            self.assertTrue(Path(fname + '.npz').exists())
+            cached = _read_WSWQ(fname)
+            self.assertEqual(set(wswq.keys()), set(cached.keys()))
+            for k, v in wswq.items():
+                self.assertTrue(np.allclose(v, cached[k]))
+
+    def test__read_WSWQ_targeted(self):
+        pairs = [(189, 192), (1, 1), (288, 288)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = str(Path(tmpdir) / 'WSWQ.gz')
+            shutil.copy(TEST_FILES / 'lower' / '10' / 'WSWQ.gz', fname)
+            targeted = {(sp, kp): _read_WSWQ_targeted(fname, sp, kp, pairs)
+                        for sp, kp in product([1, 2], [1, 2])}
+            self.assertEqual(_read_WSWQ_targeted(fname, 3, 1, pairs), {})
+            self.assertEqual(
+                set(_read_WSWQ_targeted(fname, 1, 1, [(1, 1), (300, 1)])),
+                {(1, 1)})
+            # writes the cache, which is then used by _read_WSWQ_targeted
+            wswq = _read_WSWQ(fname)
+            for (sp, kp), overlaps in targeted.items():
+                cached = _read_WSWQ_targeted(fname, sp, kp, pairs)
+                self.assertEqual(set(overlaps.keys()), set(pairs))
+                for i, j in pairs:
+                    self.assertAlmostEqual(overlaps[(i, j)],
+                                           wswq[(sp, kp)][i-1, j-1])
+                    self.assertAlmostEqual(cached[(i, j)], overlaps[(i, j)])
+            # missing blocks and indices are left out, as without the cache
+            self.assertEqual(_read_WSWQ_targeted(fname, 3, 1, pairs), {})
+            self.assertEqual(
+                set(_read_WSWQ_targeted(fname, 1, 1, [(1, 1), (300, 1)])),
+                {(1, 1)})
+            # a cache that doesn't match the file's mtime is not used
+            self.assertTrue(_get_WSWQ_cache(fname)[1])
+            os.utime(fname, (0., 0.))
+            self.assertFalse(_get_WSWQ_cache(fname)[1])
+            self.assertEqual(_read_WSWQ_targeted(fname, 1, 1, pairs),
+                             targeted[(1, 1)])
 
     def test_get_Wif_from_WSWQ(self):
         with warnings.catch_warnings():